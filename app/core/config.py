@@ -1,5 +1,4 @@
-from pydantic_settings import BaseSettings
-from functools import lru_cache
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
@@ -9,11 +8,15 @@ class Settings(BaseSettings):
     app_env: str = "development"
     new_relic_license_key: str = ""
     new_relic_app_name: str = "GoComet-RideHailing"
+    db_min_size: int = 20
+    db_max_size: int = 50
 
-    class Config:
-        env_file = ".env"
+    model_config = SettingsConfigDict(env_file=".env")
+
+
+# Read env/.env once at import; use this directly on hot paths
+SETTINGS = Settings()
 
 
-@lru_cache()
 def get_settings():
-    return Settings()
+    return SETTINGS
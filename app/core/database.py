@@ -1,13 +1,27 @@
+import logging
 import asyncpg
 import redis.asyncio as aioredis
-from app.core.config import get_settings
+from app.core.config import SETTINGS
 
-settings = get_settings()
+logger = logging.getLogger(__name__)
 
 # Global connection pools
 db_pool: asyncpg.Pool = None
 redis_client: aioredis.Redis = None
 
+# Set by init_db; matching uses the GiST/KNN query only when PostGIS exists.
+postgis_enabled: bool = False
+
+# Hot-path SQL, registered by routers at import time and prepared into every
+# pooled connection's statement cache as soon as the connection is created.
+_HOT_SQL: list = []
+
+
+def hot_sql(sql: str) -> str:
+    """Register a query for statement-cache warmup; returns it unchanged."""
+    _HOT_SQL.append(sql)
+    return sql
+
 
 async def get_db_pool() -> asyncpg.Pool:
     return db_pool
@@ -17,92 +31,153 @@ async def get_redis() -> aioredis.Redis:
     return redis_client
 
 
-async def init_db(pool: asyncpg.Pool):
+def has_postgis() -> bool:
+    return postgis_enabled
+
+
+async def init_db(conn: asyncpg.Connection):
     """Create all tables if they don't exist."""
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS drivers (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                name TEXT NOT NULL,
-                phone TEXT UNIQUE NOT NULL,
-                tier TEXT DEFAULT 'standard' CHECK (tier IN ('standard', 'premium', 'xl')),
-                status TEXT DEFAULT 'offline' CHECK (status IN ('offline', 'available', 'on_trip')),
-                latitude DOUBLE PRECISION,
-                longitude DOUBLE PRECISION,
-                last_location_update TIMESTAMPTZ,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-
-            CREATE TABLE IF NOT EXISTS riders (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                name TEXT NOT NULL,
-                phone TEXT UNIQUE NOT NULL,
-                email TEXT,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-
-            CREATE TABLE IF NOT EXISTS rides (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                rider_id UUID REFERENCES riders(id),
-                driver_id UUID REFERENCES drivers(id),
-                pickup_lat DOUBLE PRECISION NOT NULL,
-                pickup_lng DOUBLE PRECISION NOT NULL,
-                dest_lat DOUBLE PRECISION NOT NULL,
-                dest_lng DOUBLE PRECISION NOT NULL,
-                pickup_address TEXT,
-                dest_address TEXT,
-                tier TEXT DEFAULT 'standard',
-                payment_method TEXT DEFAULT 'card',
-                status TEXT DEFAULT 'requested' CHECK (status IN (
-                    'requested', 'searching', 'matched', 'accepted',
-                    'in_progress', 'paused', 'completed', 'cancelled'
-                )),
-                surge_multiplier DOUBLE PRECISION DEFAULT 1.0,
-                estimated_fare DOUBLE PRECISION,
-                final_fare DOUBLE PRECISION,
-                idempotency_key TEXT UNIQUE,
-                created_at TIMESTAMPTZ DEFAULT NOW(),
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            );
-
-            CREATE TABLE IF NOT EXISTS trips (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                ride_id UUID UNIQUE REFERENCES rides(id),
-                started_at TIMESTAMPTZ,
-                paused_at TIMESTAMPTZ,
-                ended_at TIMESTAMPTZ,
-                distance_km DOUBLE PRECISION DEFAULT 0,
-                duration_minutes DOUBLE PRECISION DEFAULT 0,
-                fare DOUBLE PRECISION,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-
-            CREATE TABLE IF NOT EXISTS payments (
-                id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                ride_id UUID REFERENCES rides(id),
-                rider_id UUID REFERENCES riders(id),
-                amount DOUBLE PRECISION NOT NULL,
-                method TEXT NOT NULL,
-                status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'success', 'failed')),
-                psp_ref TEXT,
-                idempotency_key TEXT UNIQUE,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-
-            CREATE INDEX IF NOT EXISTS idx_rides_status ON rides(status);
-            CREATE INDEX IF NOT EXISTS idx_rides_rider_id ON rides(rider_id);
-            CREATE INDEX IF NOT EXISTS idx_drivers_status ON drivers(status);
-            CREATE INDEX IF NOT EXISTS idx_drivers_location ON drivers(latitude, longitude);
-            CREATE INDEX IF NOT EXISTS idx_payments_ride_id ON payments(ride_id);
-        """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS drivers (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            name TEXT NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            tier TEXT DEFAULT 'standard' CHECK (tier IN ('standard', 'premium', 'xl')),
+            status TEXT DEFAULT 'offline' CHECK (status IN ('offline', 'available', 'on_trip')),
+            latitude DOUBLE PRECISION,
+            longitude DOUBLE PRECISION,
+            last_location_update TIMESTAMPTZ,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS riders (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            name TEXT NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            email TEXT,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS rides (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            rider_id UUID REFERENCES riders(id),
+            driver_id UUID REFERENCES drivers(id),
+            pickup_lat DOUBLE PRECISION NOT NULL,
+            pickup_lng DOUBLE PRECISION NOT NULL,
+            dest_lat DOUBLE PRECISION NOT NULL,
+            dest_lng DOUBLE PRECISION NOT NULL,
+            pickup_address TEXT,
+            dest_address TEXT,
+            tier TEXT DEFAULT 'standard',
+            payment_method TEXT DEFAULT 'card',
+            status TEXT DEFAULT 'requested' CHECK (status IN (
+                'requested', 'searching', 'matched', 'accepted',
+                'in_progress', 'paused', 'completed', 'cancelled'
+            )),
+            surge_multiplier DOUBLE PRECISION DEFAULT 1.0,
+            estimated_fare DOUBLE PRECISION,
+            final_fare DOUBLE PRECISION,
+            idempotency_key TEXT UNIQUE,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS trips (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            ride_id UUID UNIQUE REFERENCES rides(id),
+            started_at TIMESTAMPTZ,
+            paused_at TIMESTAMPTZ,
+            ended_at TIMESTAMPTZ,
+            distance_km DOUBLE PRECISION DEFAULT 0,
+            duration_minutes DOUBLE PRECISION DEFAULT 0,
+            fare DOUBLE PRECISION,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE TABLE IF NOT EXISTS payments (
+            id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+            ride_id UUID REFERENCES rides(id),
+            rider_id UUID REFERENCES riders(id),
+            amount DOUBLE PRECISION NOT NULL,
+            method TEXT NOT NULL,
+            status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'success', 'failed')),
+            psp_ref TEXT,
+            idempotency_key TEXT UNIQUE,
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_rides_status ON rides(status);
+        CREATE INDEX IF NOT EXISTS idx_rides_rider_id ON rides(rider_id);
+        CREATE INDEX IF NOT EXISTS idx_drivers_status ON drivers(status);
+        CREATE INDEX IF NOT EXISTS idx_drivers_location ON drivers(latitude, longitude);
+        CREATE INDEX IF NOT EXISTS idx_drivers_tier_lat ON drivers(tier, latitude)
+            WHERE status = 'available';
+        CREATE INDEX IF NOT EXISTS idx_payments_ride_id ON payments(ride_id);
+    """)
+
+    # Spatial index for nearest-driver lookups. PostGIS is optional so plain
+    # Postgres (e.g. local dev) still works, falling back to Haversine SQL.
+    global postgis_enabled
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+    except asyncpg.PostgresError as exc:
+        logger.warning("PostGIS unavailable, using Haversine matching: %s", exc)
+        postgis_enabled = False
+        return
+
+    await conn.execute("""
+        ALTER TABLE drivers ADD COLUMN IF NOT EXISTS geog geography(Point, 4326)
+            GENERATED ALWAYS AS (ST_MakePoint(longitude, latitude)::geography) STORED;
+
+        CREATE INDEX IF NOT EXISTS idx_drivers_geog ON drivers
+            USING GIST (geog) WHERE status = 'available';
+    """)
+    postgis_enabled = True
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    """
+    Per-connection setup. UUIDs are decoded as plain strings so rows are
+    JSON-ready; hot statements are prepared up front so first requests skip
+    the PARSE.
+    """
+    await conn.set_type_codec("uuid", encoder=str, decoder=str, schema="pg_catalog", format="text")
+    for sql in _HOT_SQL:
+        # Public prepare() bypasses the statement cache; this populates it.
+        # Some statements only apply to some schemas (e.g. PostGIS-only).
+        try:
+            await conn._prepare(sql, use_cache=True)
+        except asyncpg.PostgresError as exc:
+            logger.debug("Skipping warmup of hot statement: %s", exc)
 
 
 async def connect():
     global db_pool, redis_client
-    raw_url = settings.database_url.replace("postgresql+asyncpg://", "postgresql://")
-    db_pool = await asyncpg.create_pool(raw_url, min_size=5, max_size=20)
-    await init_db(db_pool)
-    redis_client = aioredis.from_url(settings.redis_url, decode_responses=True)
+    raw_url = SETTINGS.database_url.replace("postgresql+asyncpg://", "postgresql://")
+
+    # Schema must exist before pooled connections warm their statement caches
+    conn = await asyncpg.connect(raw_url)
+    try:
+        await init_db(conn)
+    finally:
+        await conn.close()
+
+    db_pool = await asyncpg.create_pool(
+        raw_url,
+        min_size=SETTINGS.db_min_size,
+        max_size=SETTINGS.db_max_size,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=1024,
+        max_cached_statement_lifetime=0,
+        command_timeout=5,
+        # JIT only adds planning overhead for our short OLTP queries. A startup
+        # parameter is the session default, so the pool's RESET ALL on release
+        # keeps it (a SET in the init hook would be undone).
+        server_settings={"jit": "off"},
+        init=_init_connection,
+    )
+    # Raw bytes: cached JSON is served as-is without a decode/parse round trip
+    redis_client = aioredis.from_url(SETTINGS.redis_url, decode_responses=False)
 
 
 async def disconnect():
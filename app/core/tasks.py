@@ -0,0 +1,28 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The event loop only holds weak references to tasks; keep fire-and-forget
+# work alive here until it finishes.
+_pending: set = set()
+
+
+def _log_errors(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error("Background task %s failed", task.get_name(), exc_info=task.exception())
+
+
+def spawn(coro) -> asyncio.Task:
+    """Schedule a coroutine without awaiting it; failures are logged."""
+    task = asyncio.create_task(coro)
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+    task.add_done_callback(_log_errors)
+    return task
+
+
+async def drain(timeout: float = 10.0):
+    """Wait for in-flight background tasks, e.g. before closing the pools."""
+    if _pending:
+        await asyncio.wait(list(_pending), timeout=timeout)
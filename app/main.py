@@ -1,18 +1,29 @@
+import os
 import newrelic.agent
-newrelic.agent.initialize('newrelic.ini')
+from app.core.config import SETTINGS
+
+# APM wraps every DB/Redis call and route, so only pay for it in production.
+# Must run before the instrumented libraries below are imported.
+if SETTINGS.app_env == "production" and SETTINGS.new_relic_license_key:
+    os.environ.setdefault("NEW_RELIC_LICENSE_KEY", SETTINGS.new_relic_license_key)
+    os.environ.setdefault("NEW_RELIC_APP_NAME", SETTINGS.new_relic_app_name)
+    newrelic.agent.initialize('newrelic.ini')
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from contextlib import asynccontextmanager
 import time
 import logging
 
 from app.core.database import connect, disconnect
+from app.core.tasks import drain
 from app.routers import rides, drivers, trips, payments, riders
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+_SLOW_LOG = logger.isEnabledFor(logging.WARNING)
 
 
 @asynccontextmanager
@@ -22,6 +33,7 @@ async def lifespan(app: FastAPI):
     logger.info("Connected successfully.")
     yield
     logger.info("Shutting down...")
+    await drain()
     await disconnect()
 
 
@@ -29,6 +41,9 @@ app = FastAPI(
     title="GoComet Ride Hailing API",
     description="Multi-tenant ride hailing platform with real-time matching, surge pricing, and payments.",
     version="1.0.0",
+    # No interactive docs in production; nginx only forwards /v1/* and /health
+    openapi_url=None if SETTINGS.app_env == "production" else "/openapi.json",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan,
 )
 
@@ -41,15 +56,36 @@ app.add_middleware(
 
 
 # ─── Latency tracking middleware ──────────────────────────────────────────────
-@app.middleware("http")
-async def add_latency_header(request, call_next):
-    start = time.perf_counter()
-    response = await call_next(request)
-    latency_ms = (time.perf_counter() - start) * 1000
-    response.headers["X-Response-Time-Ms"] = f"{latency_ms:.2f}"
-    if latency_ms > 500:
-        logger.warning(f"SLOW REQUEST: {request.method} {request.url.path} — {latency_ms:.0f}ms")
-    return response
+class LatencyMiddleware:
+    """
+    Pure ASGI middleware that stamps X-Response-Time-Ms on every HTTP response.
+    Avoids BaseHTTPMiddleware's per-request stream/task-group machinery.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                latency_ms = (time.perf_counter() - start) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"x-response-time-ms", f"{latency_ms:.2f}".encode()))
+                message["headers"] = headers
+                if latency_ms > 500 and _SLOW_LOG:
+                    logger.warning("SLOW REQUEST: %s %s — %.0fms", scope["method"], scope["path"], latency_ms)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+app.add_middleware(LatencyMiddleware)
 
 
 # ─── Routers ──────────────────────────────────────────────────────────────────
@@ -62,10 +98,11 @@ app.include_router(riders.router)
 
 @app.get("/health")
 async def health():
+    newrelic.agent.ignore_transaction()
     return {"status": "ok", "service": "GoComet Ride Hailing"}
 
 
-# Serve frontend
+# Serve frontend (dev fallback; in production nginx/CDN serves these directly)
 app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
 @app.get("/")
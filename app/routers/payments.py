@@ -1,12 +1,30 @@
 import uuid
 import asyncio
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from app.core.database import get_db_pool, get_redis
-from app.schemas.schemas import PaymentCreate
-import json
+from fastapi import APIRouter, HTTPException, Response
+from pydantic import TypeAdapter
+from app.core.database import get_db_pool, get_redis, hot_sql
+from app.core.tasks import spawn
+from app.schemas.schemas import PaymentCreate, PaymentResponse
+from app.services.idempotency import claim_idempotency_key, release_idempotency_key, INFLIGHT
+import orjson
 
 router = APIRouter(prefix="/v1/payments", tags=["Payments"])
 
+_CREATE_PAYMENT_SQL = hot_sql("""
+    WITH r AS (
+        SELECT rider_id, payment_method, status,
+               COALESCE(final_fare, estimated_fare, 0) AS amount
+        FROM rides WHERE id = $1
+    )
+    INSERT INTO payments (ride_id, rider_id, amount, method, idempotency_key)
+    SELECT $1, rider_id, amount, payment_method, $2 FROM r
+    WHERE status = 'completed'
+    ON CONFLICT (idempotency_key) DO UPDATE SET idempotency_key = EXCLUDED.idempotency_key
+    RETURNING *
+""")
+
+_PAYMENT_ADAPTER = TypeAdapter(PaymentResponse)
+
 
 async def _process_payment(payment_id: str, ride_id: str, amount: float, method: str):
     """
@@ -24,57 +42,61 @@ async def _process_payment(payment_id: str, ride_id: str, amount: float, method:
     psp_ref = f"psp_{uuid.uuid4().hex[:12]}" if success else None
     status = "success" if success else "failed"
 
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE payments SET status = $1, psp_ref = $2 WHERE id = $3
-        """, status, psp_ref, payment_id)
+    await pool.execute("""
+        UPDATE payments SET status = $1, psp_ref = $2 WHERE id = $3
+    """, status, psp_ref, payment_id)
 
-    await redis.delete(f"payment:{ride_id}")
+    # Invalidate status cache and notify subscribers in one round trip
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.delete(f"payment:{ride_id}")
+        pipe.publish("payments:updated", ride_id)
+        await pipe.execute()
 
 
 @router.post("", status_code=201)
-async def create_payment(payload: PaymentCreate, background_tasks: BackgroundTasks):
+async def create_payment(payload: PaymentCreate):
     """
     Trigger payment for a completed ride. Idempotent.
     """
     pool = await get_db_pool()
     redis = await get_redis()
 
-    # Idempotency check
-    if payload.idempotency_key:
-        cached = await redis.get(f"idem:pay:{payload.idempotency_key}")
-        if cached:
-            return json.loads(cached)
-
-    # Get ride details
-    async with pool.acquire() as conn:
-        ride = await conn.fetchrow("SELECT * FROM rides WHERE id = $1", payload.ride_id)
-
-    if not ride:
-        raise HTTPException(status_code=404, detail="Ride not found")
-    if ride["status"] != "completed":
-        raise HTTPException(status_code=409, detail="Ride must be completed before payment")
-
-    amount = float(ride["final_fare"] or ride["estimated_fare"] or 0)
+    idem_key = f"idem:pay:{payload.idempotency_key}" if payload.idempotency_key else None
 
-    async with pool.acquire() as conn:
-        payment = await conn.fetchrow("""
-            INSERT INTO payments (ride_id, rider_id, amount, method, idempotency_key)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (idempotency_key) DO UPDATE SET idempotency_key = EXCLUDED.idempotency_key
-            RETURNING *
-        """, payload.ride_id, str(ride["rider_id"]), amount,
-            ride["payment_method"], payload.idempotency_key)
-
-    result = {k: str(v) if hasattr(v, 'hex') else v for k, v in dict(payment).items()}
-
-    if payload.idempotency_key:
-        await redis.setex(f"idem:pay:{payload.idempotency_key}", 86400, json.dumps(result, default=str))
+    # Idempotency check; claims the key so concurrent duplicates wait on us
+    if idem_key:
+        cached = await claim_idempotency_key(idem_key)
+        if cached == INFLIGHT:
+            raise HTTPException(status_code=409, detail="A request with this idempotency_key is still in progress")
+        if cached:
+            return Response(content=cached, status_code=201, media_type="application/json")
+
+    try:
+        async with pool.acquire() as conn:
+            # Ride lookup, completion check and insert in one round trip
+            payment = await conn.fetchrow(_CREATE_PAYMENT_SQL, payload.ride_id, payload.idempotency_key)
+
+            if not payment:
+                ride = await conn.fetchrow("SELECT status FROM rides WHERE id = $1", payload.ride_id)
+                if not ride:
+                    raise HTTPException(status_code=404, detail="Ride not found")
+                raise HTTPException(status_code=409, detail="Ride must be completed before payment")
+    except Exception:
+        if idem_key:
+            await release_idempotency_key(idem_key)
+        raise
+
+    result = dict(payment)
+
+    # Cache idempotent result and drop any stale status entry in one round trip
+    async with redis.pipeline(transaction=False) as pipe:
+        if idem_key:
+            pipe.setex(idem_key, 86400, orjson.dumps(result))
+        pipe.delete(f"payment:{payload.ride_id}")
+        await pipe.execute()
 
     # Async PSP call
-    background_tasks.add_task(
-        _process_payment, str(payment["id"]), payload.ride_id, amount, ride["payment_method"]
-    )
+    spawn(_process_payment(payment["id"], payload.ride_id, payment["amount"], payment["method"]))
 
     return result
 
@@ -85,16 +107,15 @@ async def get_payment_status(ride_id: str):
     redis = await get_redis()
     cached = await redis.get(f"payment:{ride_id}")
     if cached:
-        return json.loads(cached)
+        return Response(content=cached, media_type="application/json")
 
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT * FROM payments WHERE ride_id = $1 ORDER BY created_at DESC LIMIT 1", ride_id
-        )
+    row = await pool.fetchrow(
+        "SELECT * FROM payments WHERE ride_id = $1 ORDER BY created_at DESC LIMIT 1", ride_id
+    )
     if not row:
         raise HTTPException(status_code=404, detail="No payment found for this ride")
 
-    result = {k: str(v) if hasattr(v, 'hex') else v for k, v in dict(row).items()}
-    await redis.setex(f"payment:{ride_id}", 10, json.dumps(result, default=str))
-    return result
+    body = _PAYMENT_ADAPTER.dump_json(_PAYMENT_ADAPTER.validate_python(dict(row)))
+    await redis.setex(f"payment:{ride_id}", 10, body)
+    return Response(content=body, media_type="application/json")
@@ -1,14 +1,54 @@
-import uuid
 import asyncio
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from app.core.database import get_db_pool, get_redis
+from fastapi import APIRouter, HTTPException, Response
+from pydantic import TypeAdapter
+from app.core.database import get_db_pool, get_redis, hot_sql
+from app.core.tasks import spawn
 from app.schemas.schemas import RideCreate, RideResponse
 from app.services.pricing import get_surge_multiplier, estimate_fare
-from app.services.matching import find_nearest_driver, assign_driver_to_ride
-import json
+from app.services.matching import find_nearest_driver, assign_driver_to_ride, DriverUnavailable
+from app.services.idempotency import claim_idempotency_key, release_idempotency_key, INFLIGHT
+import orjson
 
 router = APIRouter(prefix="/v1/rides", tags=["Rides"])
 
+_INSERT_RIDE_SQL = hot_sql("""
+    INSERT INTO rides (rider_id, pickup_lat, pickup_lng, dest_lat, dest_lng,
+                       pickup_address, dest_address, tier, payment_method,
+                       surge_multiplier, estimated_fare, idempotency_key)
+    VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12)
+    ON CONFLICT (idempotency_key) DO UPDATE SET idempotency_key = EXCLUDED.idempotency_key
+    RETURNING *
+""")
+
+_GET_RIDE_SQL = hot_sql("""
+    SELECT r.*, d.name as driver_name, d.phone as driver_phone,
+           d.latitude as driver_lat, d.longitude as driver_lng
+    FROM rides r
+    LEFT JOIN drivers d ON r.driver_id = d.id
+    WHERE r.id = $1
+""")
+
+# Compiled once; serializes a row to JSON bytes in a single pass
+_RIDE_ADAPTER = TypeAdapter(RideResponse)
+
+
+async def _assign_nearest(ride_id: str, pickup_lat: float, pickup_lng: float, tier: str) -> bool:
+    """Find and assign the nearest driver, retrying once if they were taken."""
+    failed = None
+    for attempt in range(2):
+        if attempt:
+            # Driver grabbed by someone else, retry once without them
+            await asyncio.sleep(0.5)
+        driver = await find_nearest_driver(pickup_lat, pickup_lng, tier, exclude=failed)
+        if not driver:
+            return False
+        try:
+            await assign_driver_to_ride(ride_id, driver["id"], tier)
+            return True
+        except DriverUnavailable:
+            failed = driver["id"]
+    return False
+
 
 async def _search_and_match(ride_id: str, pickup_lat: float, pickup_lng: float, tier: str):
     """Background task: find driver and assign."""
@@ -16,35 +56,29 @@ async def _search_and_match(ride_id: str, pickup_lat: float, pickup_lng: float,
     redis = await get_redis()
 
     # Update ride to searching
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE rides SET status = 'searching', updated_at = NOW() WHERE id = $1", ride_id
-        )
-
-    driver = await find_nearest_driver(pickup_lat, pickup_lng, tier)
+    await pool.execute(
+        "UPDATE rides SET status = 'searching', updated_at = NOW() WHERE id = $1", ride_id
+    )
 
-    if not driver:
-        async with pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE rides SET status = 'cancelled', updated_at = NOW() WHERE id = $1", ride_id
+    matched = False
+    try:
+        matched = await _assign_nearest(ride_id, pickup_lat, pickup_lng, tier)
+    finally:
+        # Never leave the ride stuck in 'searching'
+        if not matched:
+            await pool.execute(
+                "UPDATE rides SET status = 'cancelled', updated_at = NOW() "
+                "WHERE id = $1 AND status = 'searching'", ride_id
             )
         await redis.delete(f"ride:{ride_id}")
-        return
 
-    try:
-        await assign_driver_to_ride(ride_id, str(driver["id"]))
-    except Exception:
-        # Driver grabbed by someone else, retry once
-        await asyncio.sleep(0.5)
-        driver2 = await find_nearest_driver(pickup_lat, pickup_lng, tier)
-        if driver2:
-            await assign_driver_to_ride(ride_id, str(driver2["id"]))
 
-    await redis.delete(f"ride:{ride_id}")
+async def _none():
+    return None
 
 
 @router.post("", status_code=201)
-async def create_ride(payload: RideCreate, background_tasks: BackgroundTasks):
+async def create_ride(payload: RideCreate):
     """
     Create a ride request. Idempotent via idempotency_key.
     Triggers background driver matching.
@@ -52,41 +86,49 @@ async def create_ride(payload: RideCreate, background_tasks: BackgroundTasks):
     pool = await get_db_pool()
     redis = await get_redis()
 
-    # Idempotency check
-    if payload.idempotency_key:
-        cached = await redis.get(f"idem:ride:{payload.idempotency_key}")
-        if cached:
-            return json.loads(cached)
+    idem_key = f"idem:ride:{payload.idempotency_key}" if payload.idempotency_key else None
 
-    surge = await get_surge_multiplier(payload.pickup_lat, payload.pickup_lng)
-    est_fare = estimate_fare(
-        payload.tier, payload.pickup_lat, payload.pickup_lng,
-        payload.dest_lat, payload.dest_lng, surge
+    # Idempotency check (claims the key so concurrent duplicates wait on us)
+    # and surge lookup are independent Redis round trips: run them together
+    cached, surge = await asyncio.gather(
+        claim_idempotency_key(idem_key) if idem_key else _none(),
+        get_surge_multiplier(payload.pickup_lat, payload.pickup_lng),
+        return_exceptions=True,
     )
+    if isinstance(cached, Exception):
+        raise cached
+    if cached == INFLIGHT:
+        raise HTTPException(status_code=409, detail="A request with this idempotency_key is still in progress")
+    if cached:
+        return Response(content=cached, status_code=201, media_type="application/json")
 
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO rides (rider_id, pickup_lat, pickup_lng, dest_lat, dest_lng,
-                               pickup_address, dest_address, tier, payment_method,
-                               surge_multiplier, estimated_fare, idempotency_key)
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12)
-            ON CONFLICT (idempotency_key) DO UPDATE SET idempotency_key = EXCLUDED.idempotency_key
-            RETURNING *
-        """, payload.rider_id, payload.pickup_lat, payload.pickup_lng,
+    try:
+        if isinstance(surge, Exception):
+            raise surge
+        est_fare = estimate_fare(
+            payload.tier, payload.pickup_lat, payload.pickup_lng,
+            payload.dest_lat, payload.dest_lng, surge
+        )
+
+        row = await pool.fetchrow(
+            _INSERT_RIDE_SQL,
+            payload.rider_id, payload.pickup_lat, payload.pickup_lng,
             payload.dest_lat, payload.dest_lng, payload.pickup_address,
             payload.dest_address, payload.tier, payload.payment_method,
-            surge, est_fare, payload.idempotency_key)
+            surge, est_fare, payload.idempotency_key
+        )
+    except Exception:
+        if idem_key:
+            await release_idempotency_key(idem_key)
+        raise
 
     result = dict(row)
-    result["id"] = str(result["id"])
 
-    if payload.idempotency_key:
-        await redis.setex(f"idem:ride:{payload.idempotency_key}", 86400, json.dumps(result, default=str))
+    if idem_key:
+        await redis.setex(idem_key, 86400, orjson.dumps(result))
 
     # Start matching in background (non-blocking)
-    background_tasks.add_task(
-        _search_and_match, result["id"], payload.pickup_lat, payload.pickup_lng, payload.tier
-    )
+    spawn(_search_and_match(result["id"], payload.pickup_lat, payload.pickup_lng, payload.tier))
 
     return result
 
@@ -98,23 +140,16 @@ async def get_ride(ride_id: str):
 
     cached = await redis.get(f"ride:{ride_id}")
     if cached:
-        return json.loads(cached)
+        return Response(content=cached, media_type="application/json")
 
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT r.*, d.name as driver_name, d.phone as driver_phone,
-                   d.latitude as driver_lat, d.longitude as driver_lng
-            FROM rides r
-            LEFT JOIN drivers d ON r.driver_id = d.id
-            WHERE r.id = $1
-        """, ride_id)
+    row = await pool.fetchrow(_GET_RIDE_SQL, ride_id)
 
     if not row:
         raise HTTPException(status_code=404, detail="Ride not found")
 
-    result = {k: str(v) if hasattr(v, 'hex') else v for k, v in dict(row).items()}
+    body = _RIDE_ADAPTER.dump_json(_RIDE_ADAPTER.validate_python(dict(row)))
 
-    await redis.setex(f"ride:{ride_id}", 5, json.dumps(result, default=str))
+    await redis.setex(f"ride:{ride_id}", 5, body)
 
-    return result
+    return Response(content=body, media_type="application/json")
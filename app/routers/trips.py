@@ -1,10 +1,65 @@
-from fastapi import APIRouter, HTTPException
-from app.core.database import get_db_pool, get_redis
-from app.schemas.schemas import TripEndRequest
+from fastapi import APIRouter, HTTPException, Response
+from pydantic import TypeAdapter
+from app.core.database import get_db_pool, get_redis, hot_sql
+from app.schemas.schemas import TripEndRequest, TripResponse
 from app.services.pricing import calculate_fare
 
 router = APIRouter(prefix="/v1/trips", tags=["Trips"])
 
+_START_TRIP_SQL = hot_sql("""
+    WITH t AS (
+        SELECT ride_id FROM trips WHERE id = $1
+    ), r AS (
+        UPDATE rides SET status = 'in_progress', updated_at = NOW()
+        WHERE id = (SELECT ride_id FROM t) AND status = 'accepted'
+        RETURNING id
+    ), u AS (
+        UPDATE trips SET started_at = NOW()
+        WHERE id = $1 AND EXISTS (SELECT 1 FROM r)
+    )
+    SELECT (SELECT ride_id FROM t) AS ride_id, (SELECT id FROM r) AS started
+""")
+
+_PAUSE_TRIP_SQL = hot_sql("""
+    WITH t AS (
+        SELECT ride_id FROM trips WHERE id = $1
+    ), r AS (
+        UPDATE rides SET status = 'paused', updated_at = NOW()
+        WHERE id = (SELECT ride_id FROM t) AND status = 'in_progress'
+        RETURNING id
+    ), u AS (
+        UPDATE trips SET paused_at = NOW()
+        WHERE id = $1 AND EXISTS (SELECT 1 FROM r)
+    )
+    SELECT (SELECT ride_id FROM t) AS ride_id, (SELECT id FROM r) AS paused
+""")
+
+_END_TRIP_LOOKUP_SQL = hot_sql("""
+    SELECT t.ride_id, r.status, r.tier, r.surge_multiplier
+    FROM trips t
+    JOIN rides r ON r.id = t.ride_id
+    WHERE t.id = $1
+""")
+
+_END_TRIP_SQL = hot_sql("""
+    WITH r AS (
+        UPDATE rides SET status = 'completed', final_fare = $1, updated_at = NOW()
+        WHERE id = $2 AND status IN ('in_progress', 'paused')
+        RETURNING id, driver_id
+    ), t AS (
+        UPDATE trips SET ended_at = NOW(), distance_km = $3,
+                         duration_minutes = $4, fare = $1
+        WHERE id = $5 AND EXISTS (SELECT 1 FROM r)
+    ), d AS (
+        -- Free up driver
+        UPDATE drivers SET status = 'available'
+        WHERE id = (SELECT driver_id FROM r)
+    )
+    SELECT id FROM r
+""")
+
+_TRIP_ADAPTER = TypeAdapter(TripResponse)
+
 
 @router.post("/{trip_id}/start", status_code=200)
 async def start_trip(trip_id: str):
@@ -12,28 +67,16 @@ async def start_trip(trip_id: str):
     redis = await get_redis()
 
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            trip = await conn.fetchrow(
-                "SELECT * FROM trips WHERE id = $1 FOR UPDATE", trip_id
-            )
-            if not trip:
-                raise HTTPException(status_code=404, detail="Trip not found")
-
-            ride = await conn.fetchrow(
-                "SELECT * FROM rides WHERE id = $1", str(trip["ride_id"])
-            )
-            if ride["status"] not in ("accepted",):
-                raise HTTPException(status_code=409, detail=f"Cannot start trip in ride state '{ride['status']}'")
-
-            await conn.execute(
-                "UPDATE trips SET started_at = NOW() WHERE id = $1", trip_id
-            )
-            await conn.execute(
-                "UPDATE rides SET status = 'in_progress', updated_at = NOW() WHERE id = $1",
-                str(trip["ride_id"])
-            )
-
-    await redis.delete(f"ride:{str(trip['ride_id'])}")
+        # Trip lookup, state check and both updates in a single round trip
+        row = await conn.fetchrow(_START_TRIP_SQL, trip_id)
+
+        if row["ride_id"] is None:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        if row["started"] is None:
+            status = await conn.fetchval("SELECT status FROM rides WHERE id = $1", row["ride_id"])
+            raise HTTPException(status_code=409, detail=f"Cannot start trip in ride state '{status}'")
+
+    await redis.delete(f"ride:{row['ride_id']}")
     return {"status": "in_progress", "trip_id": trip_id}
 
 
@@ -43,18 +86,15 @@ async def pause_trip(trip_id: str):
     redis = await get_redis()
 
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            trip = await conn.fetchrow("SELECT * FROM trips WHERE id = $1 FOR UPDATE", trip_id)
-            if not trip:
-                raise HTTPException(status_code=404, detail="Trip not found")
-
-            await conn.execute("UPDATE trips SET paused_at = NOW() WHERE id = $1", trip_id)
-            await conn.execute(
-                "UPDATE rides SET status = 'paused', updated_at = NOW() WHERE id = $1",
-                str(trip["ride_id"])
-            )
-
-    await redis.delete(f"ride:{str(trip['ride_id'])}")
+        row = await conn.fetchrow(_PAUSE_TRIP_SQL, trip_id)
+
+        if row["ride_id"] is None:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        if row["paused"] is None:
+            status = await conn.fetchval("SELECT status FROM rides WHERE id = $1", row["ride_id"])
+            raise HTTPException(status_code=409, detail=f"Cannot pause trip in ride state '{status}'")
+
+    await redis.delete(f"ride:{row['ride_id']}")
     return {"status": "paused", "trip_id": trip_id}
 
 
@@ -68,40 +108,27 @@ async def end_trip(trip_id: str, payload: TripEndRequest):
     redis = await get_redis()
 
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            trip = await conn.fetchrow("SELECT * FROM trips WHERE id = $1 FOR UPDATE", trip_id)
-            if not trip:
-                raise HTTPException(status_code=404, detail="Trip not found")
-
-            ride = await conn.fetchrow(
-                "SELECT * FROM rides WHERE id = $1 FOR UPDATE", str(trip["ride_id"])
-            )
-            if ride["status"] not in ("in_progress", "paused"):
-                raise HTTPException(status_code=409, detail=f"Cannot end trip in ride state '{ride['status']}'")
-
-            fare = calculate_fare(
-                ride["tier"], payload.distance_km,
-                payload.duration_minutes, float(ride["surge_multiplier"])
-            )
-
-            await conn.execute("""
-                UPDATE trips SET ended_at = NOW(), distance_km = $1,
-                                 duration_minutes = $2, fare = $3
-                WHERE id = $4
-            """, payload.distance_km, payload.duration_minutes, fare, trip_id)
-
-            await conn.execute("""
-                UPDATE rides SET status = 'completed', final_fare = $1, updated_at = NOW()
-                WHERE id = $2
-            """, fare, str(trip["ride_id"]))
-
-            # Free up driver
-            await conn.execute(
-                "UPDATE drivers SET status = 'available' WHERE id = $1",
-                str(ride["driver_id"])
-            )
-
-    await redis.delete(f"ride:{str(trip['ride_id'])}")
+        ride = await conn.fetchrow(_END_TRIP_LOOKUP_SQL, trip_id)
+        if not ride:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        if ride["status"] not in ("in_progress", "paused"):
+            raise HTTPException(status_code=409, detail=f"Cannot end trip in ride state '{ride['status']}'")
+
+        fare = calculate_fare(
+            ride["tier"], payload.distance_km,
+            payload.duration_minutes, float(ride["surge_multiplier"])
+        )
+
+        # Ride, trip and driver updates in one statement; the status guard on
+        # rides makes it a no-op if the trip was ended concurrently
+        done = await conn.fetchrow(
+            _END_TRIP_SQL,
+            fare, ride["ride_id"], payload.distance_km, payload.duration_minutes, trip_id
+        )
+        if not done:
+            raise HTTPException(status_code=409, detail="Trip was already ended")
+
+    await redis.delete(f"ride:{ride['ride_id']}")
     return {
         "status": "completed",
         "trip_id": trip_id,
@@ -114,8 +141,8 @@ async def end_trip(trip_id: str, payload: TripEndRequest):
 @router.get("/{trip_id}")
 async def get_trip(trip_id: str):
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM trips WHERE id = $1", trip_id)
+    row = await pool.fetchrow("SELECT * FROM trips WHERE id = $1", trip_id)
     if not row:
         raise HTTPException(status_code=404, detail="Trip not found")
-    return {k: str(v) if hasattr(v, 'hex') else v for k, v in dict(row).items()}
+    body = _TRIP_ADAPTER.dump_json(_TRIP_ADAPTER.validate_python(dict(row)))
+    return Response(content=body, media_type="application/json")
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field, validator
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Literal, Optional
 from uuid import UUID
 from datetime import datetime
 
@@ -9,13 +9,7 @@ from datetime import datetime
 class DriverCreate(BaseModel):
     name: str = Field(..., min_length=2)
     phone: str = Field(..., min_length=10)
-    tier: str = Field(default="standard")
-
-    @validator("tier")
-    def validate_tier(cls, v):
-        if v not in ("standard", "premium", "xl"):
-            raise ValueError("tier must be standard, premium, or xl")
-        return v
+    tier: Literal["standard", "premium", "xl"] = "standard"
 
 
 class DriverLocationUpdate(BaseModel):
@@ -59,22 +53,10 @@ class RideCreate(BaseModel):
     dest_lng: float = Field(..., ge=-180, le=180)
     pickup_address: Optional[str] = None
     dest_address: Optional[str] = None
-    tier: str = Field(default="standard")
-    payment_method: str = Field(default="card")
+    tier: Literal["standard", "premium", "xl"] = "standard"
+    payment_method: Literal["card", "cash", "wallet"] = "card"
     idempotency_key: Optional[str] = None
 
-    @validator("tier")
-    def validate_tier(cls, v):
-        if v not in ("standard", "premium", "xl"):
-            raise ValueError("tier must be standard, premium, or xl")
-        return v
-
-    @validator("payment_method")
-    def validate_payment(cls, v):
-        if v not in ("card", "cash", "wallet"):
-            raise ValueError("payment_method must be card, cash, or wallet")
-        return v
-
 
 class RideResponse(BaseModel):
     id: UUID
@@ -92,8 +74,14 @@ class RideResponse(BaseModel):
     surge_multiplier: float
     estimated_fare: Optional[float]
     final_fare: Optional[float]
+    idempotency_key: Optional[str] = None
     created_at: datetime
     updated_at: datetime
+    # Joined from drivers on GET /v1/rides/{id}
+    driver_name: Optional[str] = None
+    driver_phone: Optional[str] = None
+    driver_lat: Optional[float] = None
+    driver_lng: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -102,18 +90,20 @@ class RideResponse(BaseModel):
 # ─── Trip Schemas ─────────────────────────────────────────────────────────────
 
 class TripEndRequest(BaseModel):
-    distance_km: float = Field(..., ge=0)
-    duration_minutes: float = Field(..., ge=0)
+    distance_km: float = Field(..., ge=0, le=5000, allow_inf_nan=False)
+    duration_minutes: float = Field(..., ge=0, le=10080, allow_inf_nan=False)  # one week
 
 
 class TripResponse(BaseModel):
     id: UUID
     ride_id: UUID
     started_at: Optional[datetime]
+    paused_at: Optional[datetime] = None
     ended_at: Optional[datetime]
     distance_km: float
     duration_minutes: float
     fare: Optional[float]
+    created_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -129,10 +119,12 @@ class PaymentCreate(BaseModel):
 class PaymentResponse(BaseModel):
     id: UUID
     ride_id: UUID
+    rider_id: Optional[UUID] = None
     amount: float
     method: str
     status: str
     psp_ref: Optional[str]
+    idempotency_key: Optional[str] = None
     created_at: datetime
 
     class Config:
@@ -0,0 +1,44 @@
+import asyncio
+from typing import Optional
+from app.core.database import get_redis
+
+INFLIGHT = b"__inflight__"
+INFLIGHT_TTL = 30  # seconds a claim survives if the owner dies mid-request
+
+# Atomically return the cached response, or claim the key with a short-lived
+# placeholder so concurrent duplicates don't all hit the DB.
+_CLAIM_LUA = """
+local v = redis.call('GET', KEYS[1])
+if v then return v end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2], 'NX')
+return false
+"""
+_claim_script = None
+
+_POLL_INTERVAL = 0.05
+_POLL_ATTEMPTS = 20
+
+
+async def claim_idempotency_key(key: str) -> Optional[bytes]:
+    """
+    Look up an idempotency key in one round trip, claiming it if unseen.
+    Returns the cached response, None if the caller now owns the key, or
+    INFLIGHT if another request still holds it after a brief wait.
+    """
+    global _claim_script
+    redis = await get_redis()
+    if _claim_script is None:
+        _claim_script = redis.register_script(_CLAIM_LUA)
+
+    for _ in range(_POLL_ATTEMPTS):
+        value = await _claim_script(keys=[key], args=[INFLIGHT, INFLIGHT_TTL], client=redis)
+        if value != INFLIGHT:
+            return value
+        await asyncio.sleep(_POLL_INTERVAL)
+    return INFLIGHT
+
+
+async def release_idempotency_key(key: str):
+    """Drop a claim after a failed request so retries aren't blocked."""
+    redis = await get_redis()
+    await redis.delete(key)
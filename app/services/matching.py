@@ -1,78 +1,231 @@
-import json
-import asyncio
-from typing import Optional
-from app.core.database import get_db_pool, get_redis
+import math
+import struct
+import time
+import numpy as np
+from typing import List, Optional
+from app.core.database import get_db_pool, get_redis, has_postgis, hot_sql
+from app.services.pricing import TIER_IDS, haversine_km_batch
+
+
+LOCATION_TTL = 30  # seconds a heartbeat keeps a driver matchable
+GEO_CANDIDATES = 20
+
+# driver:loc:{id} value: lat, lng (float64), tier id, status code — 18 bytes
+_LOC = struct.Struct("<ddBB")
+DRIVER_STATUS_CODES = {"offline": 0, "available": 1, "on_trip": 2}
+
+
+def _geo_key(tier: str) -> str:
+    # GEO set of last known positions per tier (geohash-scored sorted set)
+    return f"driver:geo:{tier}"
+
+
+def _available_key(tier: str) -> str:
+    # Sorted set of available drivers per tier, scored by last heartbeat time
+    return f"driver:available:{tier}"
+
+
+def _set_location(pipe, driver_id: str, lat: float, lng: float, tier: str, status: str):
+    data = _LOC.pack(lat, lng, TIER_IDS[tier], DRIVER_STATUS_CODES[status])
+    pipe.setex(f"driver:loc:{driver_id}", LOCATION_TTL, data)
+
+
+def _set_matching(pipe, driver_id: str, lat: float, lng: float, tier: str, status: str):
+    if status == "available":
+        now = time.time()
+        pipe.geoadd(_geo_key(tier), (lng, lat, driver_id))
+        pipe.zadd(_available_key(tier), {driver_id: now})
+        # Sweep drivers whose heartbeats stopped; their GEO entries are
+        # removed by the lookup script once it sees them without a score
+        pipe.zremrangebyscore(_available_key(tier), "-inf", now - LOCATION_TTL)
+    else:
+        _drop_from_matching(pipe, driver_id, tier)
 
 
 async def update_driver_location_cache(driver_id: str, lat: float, lng: float, tier: str, status: str):
     """Cache driver location in Redis for fast geo-lookup."""
     redis = await get_redis()
-    key = f"driver:loc:{driver_id}"
-    data = {"lat": lat, "lng": lng, "tier": tier, "status": status}
-    await redis.setex(key, 30, json.dumps(data))  # 30-second TTL
+    pipe = redis.pipeline(transaction=False)
+    _set_location(pipe, driver_id, lat, lng, tier, status)
+    _set_matching(pipe, driver_id, lat, lng, tier, status)
+    await pipe.execute()
+
+
+async def cache_driver_location(driver_id: str, lat: float, lng: float, tier: str, status: str):
+    """Write only driver:loc:{id}; safe with an unconfirmed (tier, status)."""
+    redis = await get_redis()
+    pipe = redis.pipeline(transaction=False)
+    _set_location(pipe, driver_id, lat, lng, tier, status)
+    await pipe.execute()
+
+
+async def update_matching_sets(driver_id: str, lat: float, lng: float, tier: str, status: str):
+    """Add or drop a driver in the GEO/availability sets; status must come from the DB."""
+    redis = await get_redis()
+    pipe = redis.pipeline(transaction=False)
+    _set_matching(pipe, driver_id, lat, lng, tier, status)
+    await pipe.execute()
+
 
+def _drop_from_matching(pipe, driver_id: str, tier: str):
+    # GEO sets are sorted sets, so ZREM removes the position too
+    pipe.zrem(_available_key(tier), driver_id)
+    pipe.zrem(_geo_key(tier), driver_id)
 
-async def find_nearest_driver(pickup_lat: float, pickup_lng: float, tier: str, radius_km: float = 5.0) -> Optional[dict]:
+
+async def mark_driver_unavailable(driver_id: str, tier: str):
+    """Drop a driver from the Redis matching sets (went offline or got a ride)."""
+    redis = await get_redis()
+    pipe = redis.pipeline(transaction=False)
+    _drop_from_matching(pipe, driver_id, tier)
+    await pipe.execute()
+
+
+# GEOSEARCH and the availability/freshness check in one server-side call:
+# walks the nearest positions and returns the first driver whose heartbeat
+# score in the availability set is recent enough, as {id, dist, {lng, lat}}.
+# Stale hits (heartbeats stopped without going offline, e.g. app crash) are
+# deleted from both sets on the way, so they can't fill the COUNT window.
+_NEAREST_CACHED_LUA = """
+local hits = redis.call('GEOSEARCH', KEYS[1], 'FROMLONLAT', ARGV[1], ARGV[2],
+                        'BYRADIUS', ARGV[3], 'km', 'ASC', 'COUNT', ARGV[5],
+                        'WITHCOORD', 'WITHDIST')
+local cutoff = tonumber(ARGV[4])
+for _, h in ipairs(hits) do
+    local seen = redis.call('ZSCORE', KEYS[2], h[1])
+    if seen and tonumber(seen) >= cutoff then return h end
+    redis.call('ZREM', KEYS[1], h[1])
+    redis.call('ZREM', KEYS[2], h[1])
+end
+return false
+"""
+_nearest_cached_script = None
+
+
+async def _find_nearest_cached(pickup_lat: float, pickup_lng: float, tier: str, radius_km: float) -> Optional[dict]:
+    """Nearest available driver from Redis GEO, or None if nothing fresh is cached."""
+    global _nearest_cached_script
+    redis = await get_redis()
+    if _nearest_cached_script is None:
+        _nearest_cached_script = redis.register_script(_NEAREST_CACHED_LUA)
+
+    hit = await _nearest_cached_script(
+        keys=[_geo_key(tier), _available_key(tier)],
+        args=[pickup_lng, pickup_lat, radius_km, time.time() - LOCATION_TTL, GEO_CANDIDATES],
+        client=redis,
+    )
+    if not hit:
+        return None
+    member, dist, (lng, lat) = hit
+    return {"id": member.decode(), "latitude": float(lat), "longitude": float(lng), "distance_km": float(dist)}
+
+
+# KNN over the partial GiST index on drivers.geog: the planner walks the index
+# in distance order, so the nearest driver comes back without scanning the
+# table; ST_DWithin caps the search radius in the same pass.
+_NEAREST_DRIVER_SQL = hot_sql("""
+    SELECT id, name, phone, latitude, longitude,
+           ST_Distance(geog, ST_MakePoint($2, $1)::geography) / 1000 AS distance_km
+    FROM drivers
+    WHERE status = 'available'
+      AND tier = $3
+      AND ST_DWithin(geog, ST_MakePoint($2, $1)::geography, $4::float8 * 1000)
+    ORDER BY geog <-> ST_MakePoint($2, $1)::geography
+    LIMIT 1
+""")
+
+# Used when the database has no PostGIS extension: no trig in SQL at all. A
+# lat/lng bounding box ($4/$5 degrees) served by idx_drivers_tier_lat picks
+# the K closest candidates by a cheap L1 distance (longitude scaled by the
+# pickup's cos, $6), and rank_by_distance computes exact Haversine for those.
+FALLBACK_CANDIDATES = 20
+_NEAREST_DRIVER_BBOX_SQL = hot_sql("""
+    SELECT id, name, phone, latitude, longitude
+    FROM drivers
+    WHERE status = 'available'
+      AND tier = $3
+      AND latitude BETWEEN $1::float8 - $4::float8 AND $1::float8 + $4::float8
+      AND longitude BETWEEN $2::float8 - $5::float8 AND $2::float8 + $5::float8
+    ORDER BY abs(latitude - $1::float8) + abs(longitude - $2::float8) * $6::float8
+    LIMIT $7
+""")
+
+
+def rank_by_distance(pickup_lat: float, pickup_lng: float, candidates: List[dict]) -> List[dict]:
+    """Sort candidate drivers nearest-first, computing all distances in one call."""
+    if not candidates:
+        return candidates
+    lats = np.fromiter((c["latitude"] for c in candidates), np.float64, len(candidates))
+    lngs = np.fromiter((c["longitude"] for c in candidates), np.float64, len(candidates))
+    dists = haversine_km_batch(pickup_lat, pickup_lng, lats, lngs)
+    order = np.argsort(dists)
+    return [dict(candidates[i], distance_km=float(dists[i])) for i in order]
+
+
+async def find_nearest_driver(pickup_lat: float, pickup_lng: float, tier: str, radius_km: float = 20.0,
+                              exclude: Optional[str] = None) -> Optional[dict]:
     """
-    Find nearest available driver using Postgres distance query.
-    Uses the Haversine formula via SQL for accuracy.
+    Find nearest available driver within radius_km.
+    Tries Redis GEO first; falls back to Postgres (PostGIS KNN index scan when
+    available, bounding-box top-K re-ranked in NumPy otherwise) when no fresh
+    candidate is cached, or when the cache offers the excluded driver again.
     """
+    driver = await _find_nearest_cached(pickup_lat, pickup_lng, tier, radius_km)
+    if driver and driver["id"] != exclude:
+        return driver
+
     pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT id, name, phone, latitude, longitude,
-                   (6371 * acos(
-                       cos(radians($1)) * cos(radians(latitude)) *
-                       cos(radians(longitude) - radians($2)) +
-                       sin(radians($1)) * sin(radians(latitude))
-                   )) AS distance_km
-            FROM drivers
-            WHERE status = 'available'
-              AND tier = $3
-              AND latitude IS NOT NULL
-              AND longitude IS NOT NULL
-              AND (6371 * acos(
-                      cos(radians($1)) * cos(radians(latitude)) *
-                      cos(radians(longitude) - radians($2)) +
-                      sin(radians($1)) * sin(radians(latitude))
-                   )) < $4
-            ORDER BY distance_km ASC
-            LIMIT 1
-        """, pickup_lat, pickup_lng, tier, radius_km)
-
-        if row:
-            return dict(row)
-
-    # Fallback: expand radius
-    if radius_km < 20:
-        return await find_nearest_driver(pickup_lat, pickup_lng, tier, radius_km * 2)
+    if has_postgis():
+        row = await pool.fetchrow(_NEAREST_DRIVER_SQL, pickup_lat, pickup_lng, tier, radius_km)
+        return dict(row) if row else None
 
+    cos_p = max(math.cos(math.radians(pickup_lat)), 0.01)
+    dlat = radius_km / 111.0
+    dlng = radius_km / (111.0 * cos_p)
+    rows = await pool.fetch(
+        _NEAREST_DRIVER_BBOX_SQL, pickup_lat, pickup_lng, tier,
+        dlat, dlng, cos_p, FALLBACK_CANDIDATES,
+    )
+    ranked = rank_by_distance(pickup_lat, pickup_lng, [dict(r) for r in rows])
+    if ranked and ranked[0]["distance_km"] < radius_km:
+        return ranked[0]
     return None
 
 
-async def assign_driver_to_ride(ride_id: str, driver_id: str):
-    """Atomically assign a driver to a ride using a transaction."""
+# Compare-and-swap: the driver only flips to on_trip if still available, and
+# the ride is only matched if that happened. One statement, no row lock held
+# across round trips.
+_ASSIGN_DRIVER_SQL = hot_sql("""
+    WITH d AS (
+        UPDATE drivers SET status = 'on_trip'
+        WHERE id = $1 AND status = 'available'
+        RETURNING id, tier
+    ), r AS (
+        UPDATE rides SET driver_id = d.id, status = 'matched', updated_at = NOW()
+        FROM d
+        WHERE rides.id = $2
+    )
+    SELECT tier FROM d
+""")
+
+
+class DriverUnavailable(Exception):
+    """The chosen driver was no longer available when assignment ran."""
+
+
+async def assign_driver_to_ride(ride_id: str, driver_id: str, tier: str):
+    """Atomically assign a driver to a ride with a single conditional update."""
     pool = await get_db_pool()
     redis = await get_redis()
 
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            # Lock the driver row to prevent double assignment
-            driver = await conn.fetchrow(
-                "SELECT id, status FROM drivers WHERE id = $1 FOR UPDATE", driver_id
-            )
-            if not driver or driver["status"] != "available":
-                raise Exception("Driver no longer available")
-
-            await conn.execute(
-                "UPDATE drivers SET status = 'on_trip' WHERE id = $1", driver_id
-            )
-            await conn.execute(
-                """UPDATE rides SET driver_id = $1, status = 'matched', updated_at = NOW()
-                   WHERE id = $2""",
-                driver_id, ride_id
-            )
-
-    # Invalidate cache
-    await redis.delete(f"driver:loc:{driver_id}")
-    await redis.delete(f"ride:{ride_id}")
+    driver = await pool.fetchrow(_ASSIGN_DRIVER_SQL, driver_id, ride_id)
+    if not driver:
+        # Whatever offered this driver was stale; don't let Redis offer it again
+        await mark_driver_unavailable(driver_id, tier)
+        raise DriverUnavailable("Driver no longer available")
+
+    # Invalidate cache in one round trip
+    pipe = redis.pipeline(transaction=False)
+    _drop_from_matching(pipe, driver_id, driver["tier"])
+    pipe.delete(f"driver:loc:{driver_id}", f"ride:{ride_id}")
+    await pipe.execute()
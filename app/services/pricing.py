@@ -1,62 +1,142 @@
+import bisect
 import math
-import asyncio
-from datetime import datetime
+import time
+from collections import OrderedDict
+import numpy as np
+from numba import njit
+from app.core.database import get_redis
 
 
-async def _get_redis():
-    from app.core.database import get_redis
-    return await get_redis()
-
 # Base fares per tier (INR)
 BASE_FARE = {"standard": 30, "premium": 60, "xl": 80}
 RATE_PER_KM = {"standard": 12, "premium": 20, "xl": 18}
 RATE_PER_MIN = {"standard": 1.5, "premium": 2.5, "xl": 2.0}
 
+# Integer tier ids index the packed rate arrays used by the compiled fare
+# math; rates are held in paise so fares round to whole paise exactly.
+TIER_STANDARD, TIER_PREMIUM, TIER_XL = 0, 1, 2
+TIER_IDS = {"standard": TIER_STANDARD, "premium": TIER_PREMIUM, "xl": TIER_XL}
+_TIERS = sorted(TIER_IDS, key=TIER_IDS.get)
+# One row per tier id: (base, per km, per minute), all in paise
+_COEFS = np.array(
+    [[BASE_FARE[t], RATE_PER_KM[t], RATE_PER_MIN[t]] for t in _TIERS], dtype=np.float64
+) * 100
+
+DEMAND_TTL = 300  # seconds a cell's demand counter lives
+DEMAND_FLUSH_INTERVAL = 1.0  # seconds between a process's Redis writes per cell
+
+# INCRBY + EXPIRE server-side in one round trip; returns the fleet-wide count.
+_DEMAND_LUA = """
+local v = redis.call('INCRBY', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return v
+"""
+_demand_script = None
+
+# Per-process demand, flushed to Redis at most once per interval per cell:
+# cell key -> [unflushed requests, last flush (monotonic), last fleet count].
+# Bounded LRU.
+_LOCAL_DEMAND_MAX = 10_000
+_local_demand: "OrderedDict[bytes, list]" = OrderedDict()
+
+# Surge tiers: demand below SURGE_THRESHOLDS[i] gets SURGE_MULTIPLIERS[i]
+SURGE_THRESHOLDS = (5, 10, 20, 40)
+SURGE_MULTIPLIERS = (1.0, 1.2, 1.5, 1.8, 2.0)
 
+
+# The explicit signature compiles eagerly at import, keeping JIT cost out of
+# the request path; cache=True reuses the machine code across restarts.
+@njit("float64(float64, float64, float64, float64)", fastmath=True, cache=True)
 def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     """Calculate straight-line distance in km between two coordinates."""
-    R = 6371
+    if lat1 == lat2 and lng1 == lng2:
+        return 0.0
+    R = 6371.0
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlambda = math.radians(lng2 - lng1)
     a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    # fastmath rounding can push a just past 1.0 for near-antipodal points
+    return R * 2 * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def haversine_km_batch(lat1: float, lng1: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Distances in km from one point to arrays of coordinates, vectorized."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lats)
+    dphi = phi2 - phi1
+    dlambda = np.radians(lngs - lng1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 6371.0 * 2 * np.arcsin(np.sqrt(a))
+
+
+def _cell_key(lat: float, lng: float) -> bytes:
+    """Redis key for a 0.01-degree grid cell: 16-bit lat and lng indices packed into 4 bytes."""
+    cell = ((int((lat + 90.0) * 100.0) & 0xFFFF) << 16) | (int((lng + 180.0) * 100.0) & 0xFFFF)
+    return b"demand:" + cell.to_bytes(4, "little")
 
 
 async def get_surge_multiplier(pickup_lat: float, pickup_lng: float) -> float:
     """
     Dynamic surge pricing based on demand in grid cell.
-    Grid cell = rounded to 2 decimal places (~1.1km resolution).
+    Grid cell = 0.01 degree of lat/lng (~1.1km resolution).
     """
-    redis = await _get_redis()
-    cell = f"{round(pickup_lat, 2)}:{round(pickup_lng, 2)}"
-    key = f"demand:{cell}"
-
-    # Increment demand counter with 5-min expiry
-    count = await redis.incr(key)
-    await redis.expire(key, 300)
-
-    # Surge tiers
-    if count < 5:
-        return 1.0
-    elif count < 10:
-        return 1.2
-    elif count < 20:
-        return 1.5
-    elif count < 40:
-        return 1.8
+    global _demand_script
+    key = _cell_key(pickup_lat, pickup_lng)
+    now = time.monotonic()
+    cell = _local_demand.get(key)
+    if cell is None:
+        cell = _local_demand[key] = [0, 0.0, 0]
+        if len(_local_demand) > _LOCAL_DEMAND_MAX:
+            # Drops the coldest cell; at most one interval of its requests is lost
+            _local_demand.popitem(last=False)
     else:
-        return 2.0
+        _local_demand.move_to_end(key)
+    cell[0] += 1
+
+    # Between flushes, estimate from the last fleet count plus local requests
+    if now - cell[1] < DEMAND_FLUSH_INTERVAL:
+        return surge_for_demand(cell[2] + cell[0])
+
+    # Claim the flush before awaiting so concurrent requests don't also flush
+    delta, cell[0], cell[1] = cell[0], 0, now
+    redis = await get_redis()
+    if _demand_script is None:
+        _demand_script = redis.register_script(_DEMAND_LUA)
+    try:
+        # Add to the demand counter with 5-min expiry
+        cell[2] = await _demand_script(keys=[key], args=[delta, DEMAND_TTL], client=redis)
+    except Exception:
+        cell[0] += delta
+        raise
+
+    return surge_for_demand(cell[2] + cell[0])
+
+
+def surge_for_demand(count: int) -> float:
+    """Map a cell's demand count to its surge multiplier."""
+    return SURGE_MULTIPLIERS[bisect.bisect_right(SURGE_THRESHOLDS, count)]
+
+
+@njit("float64(int32, float64, float64, float64)", cache=True)
+def _calc_paise(tier_i, distance_km, duration_minutes, surge):
+    paise = _COEFS[tier_i, 0] + _COEFS[tier_i, 1] * distance_km + _COEFS[tier_i, 2] * duration_minutes
+    # Round half up to whole paise; stays float so huge inputs can't wrap negative
+    return np.floor(paise * surge + 0.5)
 
 
 def calculate_fare(tier: str, distance_km: float, duration_minutes: float, surge: float) -> float:
     """Calculate trip fare."""
-    fare = (
-        BASE_FARE.get(tier, 30)
-        + RATE_PER_KM.get(tier, 12) * distance_km
-        + RATE_PER_MIN.get(tier, 1.5) * duration_minutes
-    )
-    return round(fare * surge, 2)
+    # Unknown tiers are priced as standard
+    return _calc_paise(TIER_IDS.get(tier, TIER_STANDARD), distance_km, duration_minutes, surge) / 100
+
+
+def calculate_fares_batch(tier_ids: np.ndarray, distance_km: np.ndarray,
+                          duration_minutes: np.ndarray, surge: np.ndarray) -> np.ndarray:
+    """Fares for many trips at once; tier_ids are TIER_IDS values. Matches calculate_fare."""
+    base, per_km, per_min = _COEFS[tier_ids].T
+    paise = np.floor((base + per_km * distance_km + per_min * duration_minutes) * surge + 0.5)
+    return paise / 100
 
 
 def estimate_fare(tier: str, pickup_lat: float, pickup_lng: float,
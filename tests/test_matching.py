@@ -0,0 +1,19 @@
+from app.services.matching import rank_by_distance
+from app.services.pricing import haversine_km
+
+
+class TestRankByDistance:
+    def test_orders_nearest_first_without_dropping_rows(self):
+        candidates = [
+            {"id": "far", "latitude": 13.10, "longitude": 77.60},
+            {"id": "near", "latitude": 12.98, "longitude": 77.59},
+            {"id": "mid", "latitude": 13.02, "longitude": 77.64},
+        ]
+        ranked = rank_by_distance(12.97, 77.59, candidates)
+        assert [c["id"] for c in ranked] == ["near", "mid", "far"]
+        for c in ranked:
+            expected = haversine_km(12.97, 77.59, c["latitude"], c["longitude"])
+            assert abs(c["distance_km"] - expected) < 1e-6
+
+    def test_empty(self):
+        assert rank_by_distance(12.97, 77.59, []) == []
@@ -1,5 +1,14 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
 import pytest
-from app.services.pricing import haversine_km, calculate_fare, estimate_fare
+from app.services import pricing
+from app.services.pricing import (
+    haversine_km, haversine_km_batch, calculate_fare, calculate_fares_batch, estimate_fare,
+    surge_for_demand, _cell_key, TIER_IDS,
+)
 
 
 class TestHaversine:
@@ -16,6 +25,17 @@ class TestHaversine:
         d2 = haversine_km(13.02, 77.64, 12.97, 77.59)
         assert abs(d1 - d2) < 0.001
 
+    def test_antipodal_is_finite(self):
+        dist = haversine_km(12.9716, 77.5946, -12.9716, -102.4054)
+        assert abs(dist - 6371 * 3.141592653589793) < 1.0
+
+    def test_batch_matches_scalar(self):
+        lats = np.array([12.97, 13.0166, 13.02])
+        lngs = np.array([77.59, 77.5946, 77.64])
+        batch = haversine_km_batch(12.9716, 77.5946, lats, lngs)
+        for lat, lng, d in zip(lats, lngs, batch):
+            assert abs(d - haversine_km(12.9716, 77.5946, lat, lng)) < 1e-6
+
 
 class TestFareCalculation:
     def test_standard_fare(self):
@@ -42,6 +62,107 @@ class TestFareCalculation:
         # base 80 + 5*18 + 10*2 = 80+90+20 = 190
         assert fare == 190.0
 
+    def test_huge_distance_stays_positive(self):
+        assert calculate_fare("standard", 1e18, 1.0, 1.0) > 1e18
+
+    def test_batch_matches_scalar(self):
+        tiers = ["standard", "premium", "xl", "standard"]
+        km = np.array([5.0, 10.0, 5.0, 0.0])
+        minutes = np.array([15.0, 20.0, 10.0, 0.0])
+        surge = np.array([1.0, 1.5, 1.0, 2.0])
+        fares = calculate_fares_batch(np.array([TIER_IDS[t] for t in tiers]), km, minutes, surge)
+        for i, tier in enumerate(tiers):
+            assert fares[i] == calculate_fare(tier, km[i], minutes[i], surge[i])
+
+
+class TestSurge:
+    def test_tier_boundaries(self):
+        assert surge_for_demand(1) == 1.0
+        assert surge_for_demand(4) == 1.0
+        assert surge_for_demand(5) == 1.2
+        assert surge_for_demand(19) == 1.5
+        assert surge_for_demand(39) == 1.8
+        assert surge_for_demand(40) == 2.0
+        assert surge_for_demand(500) == 2.0
+
+    def test_cell_key(self):
+        assert _cell_key(12.9712, 77.5941) == _cell_key(12.9788, 77.5999)
+        assert _cell_key(12.9712, 77.5941) != _cell_key(12.9812, 77.5941)
+        assert _cell_key(12.9712, 77.5941) != _cell_key(12.9712, 77.6041)
+        assert len(_cell_key(-89.99, -179.99)) == len(b"demand:") + 4
+
+
+class _FakeDemandScript:
+    """Stands in for the registered INCRBY Lua script; records each flush."""
+
+    def __init__(self, fail=False):
+        self.counts = {}
+        self.flushes = []
+        self.fail = fail
+
+    async def __call__(self, keys, args, client):
+        if self.fail:
+            raise ConnectionError("redis down")
+        key, delta = keys[0], args[0]
+        self.flushes.append(delta)
+        self.counts[key] = self.counts.get(key, 0) + delta
+        return self.counts[key]
+
+
+class TestLocalDemand:
+    @pytest.fixture
+    def demand(self, monkeypatch):
+        clock = SimpleNamespace(now=1000.0)
+        script = _FakeDemandScript()
+
+        async def no_redis():
+            return None
+
+        monkeypatch.setattr(pricing, "_local_demand", OrderedDict())
+        monkeypatch.setattr(pricing, "_demand_script", script)
+        monkeypatch.setattr(pricing, "get_redis", no_redis)
+        monkeypatch.setattr(pricing, "time", SimpleNamespace(monotonic=lambda: clock.now))
+        return clock, script
+
+    @staticmethod
+    def surge(n=1, lat=12.97, lng=77.59):
+        async def run():
+            return [await pricing.get_surge_multiplier(lat, lng) for _ in range(n)]
+        return asyncio.run(run())
+
+    def test_first_request_flushes_then_batches(self, demand):
+        clock, script = demand
+        self.surge(6)
+        assert script.flushes == [1]
+        clock.now += pricing.DEMAND_FLUSH_INTERVAL
+        self.surge()
+        assert script.flushes == [1, 6]
+
+    def test_estimate_includes_unflushed_requests(self, demand):
+        _, script = demand
+        # One flushed request plus four local ones crosses the first tier
+        assert self.surge(5) == [1.0, 1.0, 1.0, 1.0, 1.2]
+        assert script.flushes == [1]
+
+    def test_failed_flush_restores_pending(self, demand):
+        clock, script = demand
+        self.surge(3)
+        clock.now += pricing.DEMAND_FLUSH_INTERVAL
+        script.fail = True
+        with pytest.raises(ConnectionError):
+            self.surge()
+        script.fail = False
+        clock.now += pricing.DEMAND_FLUSH_INTERVAL
+        self.surge()
+        assert script.flushes == [1, 4]
+
+    def test_cells_are_bounded(self, demand, monkeypatch):
+        monkeypatch.setattr(pricing, "_LOCAL_DEMAND_MAX", 3)
+        for i in range(5):
+            self.surge(lat=10.0 + i / 10)
+        assert len(pricing._local_demand) == 3
+        assert pricing._cell_key(10.0, 77.59) not in pricing._local_demand
+
 
 class TestEstimateFare:
     def test_returns_positive(self):